@@ -10,16 +10,20 @@ import torch
 import torch.nn.functional as F
 from beartype import beartype
 from coqpit import Coqpit
-from einops import pack, rearrange, repeat, unpack
-from einops.layers.torch import Rearrange
+from einops import rearrange
 from packaging import version
-from torch import einsum, nn
+from torch import nn
 from torch.amp import autocast
 from torch.nn import Module, ModuleList
 from torch.nn.attention import SDPBackend
 from tqdm import tqdm
 from utils import register_model
 
+try:
+    from kernel.rotary import apply_rotary_emb as apply_rotary_emb_kernel
+except ModuleNotFoundError:
+    apply_rotary_emb_kernel = None
+
 # helpers
 
 
@@ -54,6 +58,7 @@ class Attend(nn.Module):
 
         self.causal = causal
         self.flash = flash
+        self.register_buffer("causal_mask", None, persistent=False)
         assert not (
             flash and version.parse(torch.__version__) < version.parse("2.0.0")
         ), "in order to use flash attention, you must be using pytorch 2.0 or above"
@@ -68,24 +73,33 @@ class Attend(nn.Module):
         if not torch.cuda.is_available() or not flash:
             return
 
-        device_properties = torch.cuda.get_device_properties(torch.device("cuda"))
+        # flash attention 2 runs on ampere and newer (and picks fa3 on hopper),
+        # sdpa skips it by itself for inputs it cannot handle
 
-        if device_properties.major == 8 and device_properties.minor == 0:
-            print_once(
-                "A100 GPU detected, using flash attention if input tensor is on cuda"
-            )
-            self.attn_cfg = [SDPBackend.FLASH_ATTENTION]
-        else:
-            print_once(
-                "Non-A100 GPU detected, using math or mem efficient attention if input tensor is on cuda"
-            )
-            self.attn_cfg = [SDPBackend.MATH, SDPBackend.EFFICIENT_ATTENTION]
+        print_once("using flash attention if input tensor is on cuda")
+        self.attn_cfg = [
+            SDPBackend.FLASH_ATTENTION,
+            SDPBackend.EFFICIENT_ATTENTION,
+            SDPBackend.MATH,
+        ]
 
     def get_mask(self, i, j, device):
-        return torch.ones((i, j), device=device, dtype=torch.bool).triu(j - i + 1)
+        # the (i, j) causal mask aligned to the bottom right is a slice of the square
+        # (j, j) one, which is cached and only rebuilt for longer keys or a new device
+
+        if (
+            not exists(self.causal_mask)
+            or self.causal_mask.shape[-1] < j
+            or self.causal_mask.device != device
+        ):
+            self.causal_mask = torch.ones((j, j), device=device, dtype=torch.bool).triu(
+                1
+            )
+
+        return self.causal_mask[j - i : j, :j]
 
     def flash_attn(self, q, k, v, mask=None, attn_bias=None):
-        _, heads, q_len, _, k_len, is_cuda, device = (
+        _, _, q_len, _, k_len, is_cuda, device = (
             *q.shape,
             k.shape[-2],
             q.is_cuda,
@@ -100,12 +114,31 @@ class Attend(nn.Module):
         if v.ndim == 3:
             v = rearrange(v, "b n d -> b 1 n d")
 
-        # Check if mask exists and expand to compatible shape
-        # The mask is B L, so it would have to be expanded to B H N L
+        # Check if mask exists and reshape to a broadcastable shape
+        # The mask is B L, sdpa broadcasts B 1 1 L over heads and queries
+        # an additive float mask keeps sdpa off the math fallback a bool mask forces
 
         if exists(mask) and mask.ndim != 4:
             mask = rearrange(mask, "b j -> b 1 1 j")
-            mask = mask.expand(-1, heads, q_len, -1)
+
+        # sdpa aligns the causal mask to the top left, queries decoded against
+        # cached keys need it aligned to the bottom right
+
+        is_causal = self.causal and q_len == k_len
+
+        if self.causal and not is_causal and q_len > 1:
+            causal_mask = ~self.get_mask(q_len, k_len, device)
+            mask = causal_mask if not exists(mask) else mask & causal_mask
+
+        if exists(mask):
+            if mask.dtype == torch.bool:
+                mask = torch.zeros_like(mask, dtype=q.dtype).masked_fill(
+                    ~mask, -torch.finfo(q.dtype).max
+                )
+
+        # flash attention needs a unit stride on the head dimension (half precision comes from autocast)
+
+        q, k, v = map(lambda t: t if t.stride(-1) == 1 else t.contiguous(), (q, k, v))
 
         # pytorch 2.0 flash attn: q, k, v, mask, dropout, causal, softmax_scale
 
@@ -116,7 +149,7 @@ class Attend(nn.Module):
                 v,
                 attn_mask=mask,
                 dropout_p=self.dropout if self.training else 0.0,
-                is_causal=self.causal,
+                is_causal=is_causal,
             )
         return out
 
@@ -129,18 +162,39 @@ class Attend(nn.Module):
         d - feature dimension
         """
 
-        q_len, k_len, device = q.shape[-2], k.shape[-2], q.device
-
-        scale = q.shape[-1] ** -0.5
+        b, h, q_len, d = q.shape
+        k_len, device = k.shape[-2], q.device
 
-        kv_einsum_eq = "b j d" if k.ndim == 3 else "b h j d"
+        scale = d**-0.5
 
         if self.flash:
             return self.flash_attn(q, k, v, mask=mask)
 
+        # single headed key / values are expanded once into the heads dimension
+
+        if k.ndim == 3:
+            k = rearrange(k, "b j d -> b 1 j d").expand(-1, h, -1, -1)
+
+        if v.ndim == 3:
+            v = rearrange(v, "b j d -> b 1 j d").expand(-1, h, -1, -1)
+
+        # fold heads into batch for bmm
+
+        q, k, v = (
+            q.reshape(b * h, q_len, d),
+            k.reshape(b * h, k_len, d),
+            v.reshape(b * h, k_len, d),
+        )
+
         # similarity
 
-        sim = einsum(f"b h i d, {kv_einsum_eq} -> b h i j", q, k) * scale
+        sim = torch.baddbmm(
+            torch.empty(b * h, q_len, k_len, device=device, dtype=q.dtype),
+            q,
+            k.transpose(1, 2),
+            beta=0.0,
+            alpha=scale,
+        )
 
         # causal mask
 
@@ -155,7 +209,7 @@ class Attend(nn.Module):
 
         # aggregate values
 
-        out = einsum(f"b h i j, {kv_einsum_eq} -> b h i d", attn, v)
+        out = torch.bmm(attn, v).view(b, h, q_len, d)
 
         return out
 
@@ -171,14 +225,6 @@ def default(val, d):
     return val if exists(val) else d
 
 
-def pack_one(t, pattern):
-    return pack([t], pattern)
-
-
-def unpack_one(t, ps, pattern):
-    return unpack(t, ps, pattern)[0]
-
-
 def remainder_to_mult(num, mult):
     return (mult - num % mult) % mult
 
@@ -194,6 +240,17 @@ def reduce_mult(nums):
 # tensor helpers
 
 
+def autocast_dtype(t):
+    # the dtype linears hand out for t inside an autocast region
+
+    device_type = t.device.type
+
+    if hasattr(torch, "get_autocast_dtype") and torch.is_autocast_enabled(device_type):
+        return torch.get_autocast_dtype(device_type)
+
+    return t.dtype
+
+
 def log(t, eps=1e-20):
     return torch.log(t.clamp(min=eps))
 
@@ -203,26 +260,32 @@ def gumbel_noise(t):
     return -log(-log(noise))
 
 
-def gumbel_sample(t, temperature=1.0, dim=-1):
-    return ((t / temperature) + gumbel_noise(t)).argmax(dim=dim)
+def top_k_count(num_logits, thres=0.5):
+    return max(int((1 - thres) * num_logits), 1)
+
 
+@torch.compile
+def sample_top_k_gumbel(logits, k, temperature=1.0):
+    # gumbel sample among the top k logits only, never materializing the
+    # -inf filled vocab sized tensor
 
-def top_k(logits, thres=0.5):
-    num_logits = logits.shape[-1]
-    k = max(int((1 - thres) * num_logits), 1)
-    val, ind = torch.topk(logits, k)
-    probs = torch.full_like(logits, float("-inf"))
-    probs.scatter_(1, ind, val)
-    return probs
+    vals, ind = logits.topk(k, dim=-1)
+    sampled = ((vals / temperature) + gumbel_noise(vals)).argmax(dim=-1)
+    return ind.gather(-1, sampled.unsqueeze(-1)).squeeze(-1)
 
 
 # token shift, from Peng et al of RWKV
 
 
 def token_shift(t):
-    t, t_shift = t.chunk(2, dim=-1)
-    t_shift = F.pad(t_shift, (0, 0, 1, -1))
-    return torch.cat((t, t_shift), dim=-1)
+    # shift the second half of the features one step along the sequence, written
+    # into a contiguous copy rather than padding by -1 and concatenating
+
+    half = math.ceil(t.shape[-1] / 2)
+    out = t.clone()
+    out[..., 1:, half:] = t[..., :-1, half:]
+    out[..., 0, half:] = 0.0
+    return out
 
 
 # rotary positional embedding
@@ -233,27 +296,56 @@ class RotaryEmbedding(Module):
         super().__init__()
         inv_freq = 1.0 / (theta ** (torch.arange(0, dim, 2).float() / dim))
         self.register_buffer("inv_freq", inv_freq)
+        self.register_buffer("cos_cached", None, persistent=False)
+        self.register_buffer("sin_cached", None, persistent=False)
+        self.cached_len = 0
 
     @property
     def device(self):
         return next(self.buffers()).device
 
-    @autocast("cuda", enabled=False)
-    def forward(self, seq_len):
-        t = torch.arange(seq_len, device=self.device).type_as(self.inv_freq)
-        freqs = torch.einsum("i , j -> i j", t, self.inv_freq)
-        freqs = torch.cat((freqs, freqs), dim=-1)
-        return freqs
+    def _update_cache(self, seq_len, device, dtype):
+        # only grow the cos / sin tables when a longer sequence comes in
+
+        if (
+            seq_len <= self.cached_len
+            and self.cos_cached.device == device
+            and self.cos_cached.dtype == dtype
+        ):
+            return
+
+        # the angles are computed in fp32, only the tables are cast down
+
+        with autocast(device.type, enabled=False):
+            t = torch.arange(seq_len, device=device, dtype=torch.float32)
+            freqs = torch.outer(t, self.inv_freq.float())
 
+        self.cos_cached = freqs.cos().to(dtype)
+        self.sin_cached = freqs.sin().to(dtype)
+        self.cached_len = seq_len
 
-def rotate_half(x):
-    x1, x2 = x.chunk(2, dim=-1)
-    return torch.cat((-x2, x1), dim=-1)
+    def forward(self, seq_len, dtype=None):
+        self._update_cache(seq_len, self.device, default(dtype, self.inv_freq.dtype))
+        return self.cos_cached[:seq_len], self.sin_cached[:seq_len]
 
 
-@autocast("cuda", enabled=False)
-def apply_rotary_pos_emb(pos, t):
-    return t * pos.cos() + rotate_half(t) * pos.sin()
+def apply_rotary_pos_emb(cos, sin, t):
+    # cos / sin hold the half dim tables, rotating the 1st and 2nd half of t
+
+    # inductor already fuses the pytorch version when compiling
+
+    if (
+        exists(apply_rotary_emb_kernel)
+        and t.is_cuda
+        and not torch.compiler.is_compiling()
+    ):
+        cos, sin = cos.type_as(t), sin.type_as(t)
+        out = apply_rotary_emb_kernel(t.transpose(1, 2), cos, sin)
+        return out.transpose(1, 2)
+
+    t1, t2 = t.chunk(2, dim=-1)
+    out = torch.cat((t1 * cos - t2 * sin, t2 * cos + t1 * sin), dim=-1)
+    return out.type_as(t)
 
 
 # norm
@@ -262,13 +354,16 @@ def apply_rotary_pos_emb(pos, t):
 class RMSNorm(Module):
     def __init__(self, dim, eps=1e-8):
         super().__init__()
-        self.scale = dim**-0.5
         self.eps = eps
         self.g = nn.Parameter(torch.ones(dim))
 
     def forward(self, x):
-        norm = torch.norm(x, dim=-1, keepdim=True) * self.scale
-        return x / norm.clamp(min=self.eps) * self.g
+        if hasattr(F, "rms_norm"):
+            return F.rms_norm(x, x.shape[-1:], weight=self.g, eps=self.eps)
+
+        # pytorch < 2.4, the llama form that inductor fuses into one kernel
+
+        return x * torch.rsqrt(x.pow(2).mean(-1, keepdim=True) + self.eps) * self.g
 
 
 # helper classes
@@ -284,6 +379,52 @@ def FeedForward(*, dim, mult=4, dropout=0.0):
     )
 
 
+class KVCache:
+    """
+    per layer key / value buffers used for incremental decoding, preallocated to
+    max_len on the first update and filled in place, along with the last layer
+    inputs that token shift needs to look back on
+    """
+
+    def __init__(self, max_len):
+        self.max_len = max_len
+        self.k = None
+        self.v = None
+        self.attn_shift = None
+        self.ff_shift = None
+        self.len = 0
+
+    def reset(self):
+        self.attn_shift = None
+        self.ff_shift = None
+        self.len = 0
+
+    def update(self, k, v):
+        b, h, n, d = k.shape
+
+        if not exists(self.k) or self.k.shape[0] != b or self.k.dtype != k.dtype:
+            self.k = k.new_empty((b, h, self.max_len, d))
+            self.v = v.new_empty((b, h, self.max_len, d))
+
+        assert (
+            self.len + n <= self.max_len
+        ), f"kv cache of length {self.max_len} overflows"
+
+        self.k[:, :, self.len : self.len + n] = k
+        self.v[:, :, self.len : self.len + n] = v
+        self.len += n
+
+        return self.k[:, :, : self.len], self.v[:, :, : self.len]
+
+
+def cached_token_shift(t, prev):
+    # token shift continuing from the last token seen by the cache
+
+    prev = default(prev, torch.zeros_like(t[..., :1, :]))
+    shifted = token_shift(torch.cat((prev, t), dim=-2))[..., 1:, :]
+    return shifted, t[..., -1:, :]
+
+
 class Attention(Module):
     def __init__(self, *, dim, dim_head=64, heads=8, dropout=0.0, flash=False):
         super().__init__()
@@ -295,24 +436,42 @@ class Attention(Module):
 
         self.dropout = nn.Dropout(dropout)
         self.norm = RMSNorm(dim)
-        self.to_q = nn.Linear(dim, inner_dim, bias=False)
-        self.to_kv = nn.Linear(dim, inner_dim * 2, bias=False)
+        self.to_qkv = nn.Linear(dim, inner_dim * 3, bias=False)
         self.to_out = nn.Linear(inner_dim, dim, bias=False)
 
-    def forward(self, x, rotary_emb=None):
+        self._register_load_state_dict_pre_hook(self._fuse_qkv_weights)
+
+    @staticmethod
+    def _fuse_qkv_weights(state_dict, prefix, *args):
+        # checkpoints saved with separate to_q and to_kv projections
+
+        q_key, kv_key = f"{prefix}to_q.weight", f"{prefix}to_kv.weight"
+
+        if q_key in state_dict and kv_key in state_dict:
+            state_dict[f"{prefix}to_qkv.weight"] = torch.cat(
+                (state_dict.pop(q_key), state_dict.pop(kv_key)), dim=0
+            )
+
+    def forward(self, x, rotary_emb=None, cache=None):
         h, device = self.heads, x.device
+        b, n, dim = x.shape
 
-        x = self.norm(x)
-        q, k, v = (self.to_q(x), *self.to_kv(x).chunk(2, dim=-1))
-        q, k, v = map(lambda t: rearrange(t, "b n (h d) -> b h n d", h=h), (q, k, v))
+        # project as a 2d matrix so the linears run through addmm
+
+        x = self.norm(x).reshape(b * n, dim)
+        qkv = self.to_qkv(x).view(b, n, 3, h, -1)
+        q, k, v = qkv.permute(2, 0, 3, 1, 4).unbind(0)
 
         if exists(rotary_emb):
-            q, k = map(lambda t: apply_rotary_pos_emb(rotary_emb, t), (q, k))
+            q, k = map(lambda t: apply_rotary_pos_emb(*rotary_emb, t), (q, k))
+
+        if exists(cache):
+            k, v = cache.update(k, v)
 
         out = self.attend(q, k, v)
 
-        out = rearrange(out, "b h n d -> b n (h d)")
-        return self.to_out(out)
+        out = rearrange(out, "b h n d -> (b n) (h d)")
+        return self.to_out(out).view(b, n, dim)
 
 
 class Transformer(Module):
@@ -328,9 +487,16 @@ class Transformer(Module):
         ff_mult=4,
         rel_pos=True,
         flash_attn=False,
+        rotary_emb=None,
     ):
         super().__init__()
-        self.rotary_emb = RotaryEmbedding(dim_head) if rel_pos else None
+
+        # a rotary embedding may be shared across transformers to reuse its tables
+
+        if not exists(rotary_emb) and rel_pos:
+            rotary_emb = RotaryEmbedding(dim_head)
+
+        self.rotary_emb = rotary_emb if rel_pos else None
         self.layers = ModuleList([])
 
         for _ in range(layers):
@@ -351,9 +517,11 @@ class Transformer(Module):
 
         self.norm = RMSNorm(dim)
 
-    def forward(self, x):
-        n = x.shape[-2]
-        rotary_emb = self.rotary_emb(n) if exists(self.rotary_emb) else None
+    def forward(self, x, rotary_emb=None):
+        # kept free of python side effects so it compiles as a single graph
+
+        if not exists(rotary_emb) and exists(self.rotary_emb):
+            rotary_emb = self.rotary_emb(x.shape[-2], dtype=autocast_dtype(x))
 
         for attn, ff in self.layers:
             x = attn(token_shift(x), rotary_emb=rotary_emb) + x
@@ -361,6 +529,27 @@ class Transformer(Module):
 
         return self.norm(x)
 
+    def decode(self, x, caches):
+        # incremental forward that appends to one kv cache per layer
+
+        n = x.shape[-2]
+        offset = caches[0].len
+
+        rotary_emb = None
+
+        if exists(self.rotary_emb):
+            cos, sin = self.rotary_emb(offset + n, dtype=autocast_dtype(x))
+            rotary_emb = (cos[offset:], sin[offset:])
+
+        for (attn, ff), cache in zip(self.layers, caches):
+            shifted, cache.attn_shift = cached_token_shift(x, cache.attn_shift)
+            x = attn(shifted, rotary_emb=rotary_emb, cache=cache) + x
+
+            shifted, cache.ff_shift = cached_token_shift(x, cache.ff_shift)
+            x = ff(shifted) + x
+
+        return self.norm(x)
+
 
 # main class
 
@@ -380,6 +569,7 @@ class MegaByteConfig(Coqpit):
     rel_pos: bool = False
     pos_emb: bool = False
     flash_attn: bool = True
+    compile_transformers: bool = False  # per stage torch.compile with cuda graphs
 
 
 class MegaByte(Module):
@@ -419,6 +609,7 @@ class MegaByte(Module):
         *_, fine_dim = dim
 
         self.max_seq_len = max_seq_len
+        self.compile_transformers = config.compile_transformers
 
         self.start_tokens = nn.ParameterList(
             [
@@ -448,13 +639,19 @@ class MegaByte(Module):
             self.token_embs.append(
                 nn.Sequential(
                     nn.Embedding(num_tokens, fine_dim),
-                    Rearrange("... r d -> ... (r d)"),
+                    nn.Flatten(start_dim=-2),  # ... r d -> ... (r d)
                     nn.LayerNorm(patch_size * fine_dim),
                     nn.Linear(patch_size * fine_dim, dim_out),
                     nn.LayerNorm(dim_out),
                 )
             )
 
+        # one rotary embedding shared by all stages, its cos / sin cache is reused
+        # across every layer. it is registered under each transformer, which keeps
+        # the state dict keys of per stage rotary embeddings
+
+        rotary_emb = RotaryEmbedding(dim_head) if rel_pos else None
+
         self.transformers = ModuleList([])
         self.to_next_transformer_projections = ModuleList([])
 
@@ -472,6 +669,7 @@ class MegaByte(Module):
                     ff_mult=ff_mult,
                     rel_pos=rel_pos,
                     flash_attn=flash_attn,
+                    rotary_emb=rotary_emb,
                 )
             )
 
@@ -479,16 +677,28 @@ class MegaByte(Module):
 
             if exists(next_h_dim):
                 proj = nn.Sequential(
-                    Rearrange("b ... d -> b (...) d"),
+                    nn.Flatten(start_dim=1, end_dim=-2),  # b ... d -> b (...) d
                     nn.Linear(h_dim, next_h_dim * next_seq_len),
-                    Rearrange("b m (n d) -> (b m) n d", n=next_seq_len),
+                    nn.Unflatten(-1, (next_seq_len, next_h_dim)),  # (n d) -> n d
+                    nn.Flatten(start_dim=0, end_dim=1),  # b m n d -> (b m) n d
                 )
 
             self.to_next_transformer_projections.append(proj)
 
+        # the stage shapes are fixed by max_seq_len, so each transformer is compiled
+        # once for its padded length and the captured cuda graphs are replayed.
+        # token shift, norms, qkv projection and the residual adds fuse in the graph
+
+        if self.compile_transformers:
+            for transformer in self.transformers:
+                transformer.compile(
+                    mode="reduce-overhead", dynamic=False, fullgraph=True
+                )
+
         self.to_logits = nn.Linear(fine_dim, num_tokens)
         self.pad_id = pad_id
 
+    @torch.no_grad()
     def generate(
         self, prime=None, filter_thres=0.9, temperature=1.0, default_batch_size=1
     ):
@@ -500,43 +710,153 @@ class MegaByte(Module):
                 (default_batch_size, 0), dtype=torch.long, device=device
             )
 
-        seq = prime
-        batch = seq.shape[0]
+        batch, prime_len = prime.shape
+
+        # allocate the full length sequence once and fill it in place
+
+        seq = torch.full(
+            (batch, total_seq_len), self.pad_id, dtype=torch.long, device=device
+        )
+        seq[:, :prime_len] = prime
+
+        # one kv cache per layer of every stage, each stage only ever decodes
+        # the single patch the current token falls in
+
+        caches = [
+            [KVCache(stage_seq_len + 1) for _ in transformer.layers]
+            for transformer, stage_seq_len in zip(self.transformers, self.max_seq_len)
+        ]
+        stage_reprs = [None] * self.stages
+
+        # the start tokens alone give the logits for the first token
+
+        logits = self.decode_step(seq, -1, caches, stage_reprs)
+
+        for pos in range(prime_len):
+            logits = self.decode_step(seq, pos, caches, stage_reprs)
+
+        k = top_k_count(self.to_logits.out_features, thres=filter_thres)
 
-        for _ in tqdm(range(total_seq_len - seq.shape[-1])):
-            logits = self.forward(seq)[:, -1]
-            logits = top_k(logits, thres=filter_thres)
-            sampled = gumbel_sample(logits, dim=-1, temperature=temperature)
-            seq = torch.cat((seq, rearrange(sampled, "b -> b 1")), dim=-1)
+        for cur in tqdm(range(prime_len, total_seq_len)):
+            seq[:, cur] = sample_top_k_gumbel(logits, k, temperature)
+
+            if cur + 1 < total_seq_len:
+                logits = self.decode_step(seq, cur, caches, stage_reprs)
 
         return seq.reshape(batch, *self.max_seq_len)
 
+    def decode_step(self, seq, pos, caches, stage_reprs):
+        """
+        feed the token at flat position pos through the hierarchy and return the
+        logits for the token after it. a coarser stage only runs when pos starts
+        one of its patches, the finest stage runs on every token. pos -1 only feeds
+        the start token of every stage, as the training forward does for position 0
+        """
+
+        batch = seq.shape[0]
+        pos_embs = default(self.pos_embs, (None,) * self.stages)
+
+        for stage, (transformer, stage_seq_len, pos_emb) in enumerate(
+            zip(self.transformers, self.max_seq_len, pos_embs)
+        ):
+            is_last = stage == self.stages - 1
+            patch_size = reduce_mult(self.max_seq_len[stage + 1 :])
+
+            if pos != -1 and pos % patch_size != 0:
+                continue
+
+            ind = 0 if pos == -1 else (pos // patch_size) % stage_seq_len
+            token_emb = self.token_embs[self.stages - 1 - stage]
+
+            # a new patch of this stage starts with its start token, which is never
+            # summed with the previous hierarchy's representation. the patches that
+            # start at pos 0 were already started by the pos -1 step
+
+            starts_patch = ind == 0 and pos != 0
+
+            if starts_patch:
+                for cache in caches[stage]:
+                    cache.reset()
+
+                start_tokens = self.start_tokens[stage].expand(batch, 1, -1)
+                attended = transformer.decode(start_tokens, caches[stage])
+
+            # the finest stage attends the current token, coarser stages attend
+            # the patch that was just completed, which feeds the patch starting at pos
+
+            tokens_ind = -1 if pos == -1 else (ind if is_last else ind - 1)
+
+            if tokens_ind >= 0:
+                ids = seq[:, pos] if is_last else seq[:, pos - patch_size : pos]
+                tokens = token_emb(ids)
+
+                if exists(pos_emb):
+                    tokens = tokens + pos_emb.weight[tokens_ind]
+
+                if exists(stage_reprs[stage]):
+                    tokens = tokens + stage_reprs[stage][:, tokens_ind]
+
+                attended = transformer.decode(
+                    rearrange(tokens, "b d -> b 1 d"), caches[stage]
+                )
+            elif not starts_patch:
+                continue
+
+            if is_last:
+                return self.to_logits(attended)[:, -1]
+
+            stage_reprs[stage + 1] = self.to_next_transformer_projections[stage](
+                attended
+            )
+
+    def attend_stage(self, transformer, tokens, stage_seq_len):
+        if not self.compile_transformers:
+            return transformer(tokens)
+
+        # pad to the static stage length (plus start token), so the same graph is
+        # reused. attention is causal, so the padding is not seen. the rotary tables
+        # are built outside of the compiled graph
+
+        n = tokens.shape[-2]
+        tokens = F.pad(tokens, (0, 0, 0, stage_seq_len - n), value=0.0)
+
+        rotary_emb = None
+
+        if exists(transformer.rotary_emb):
+            rotary_emb = transformer.rotary_emb(
+                stage_seq_len, dtype=autocast_dtype(tokens)
+            )
+
+        return transformer(tokens, rotary_emb=rotary_emb)[..., :n, :]
+
     def forward_empty(self, batch_size):
         # take care of special case
         # where you sample from input of 0 (start token only)
 
         prev_stage_tokens_repr = None
 
-        for stage_start_tokens, transformer, proj in zip(
-            self.start_tokens, self.transformers, self.to_next_transformer_projections
+        for stage_start_tokens, transformer, proj, stage_seq_len in zip(
+            self.start_tokens,
+            self.transformers,
+            self.to_next_transformer_projections,
+            self.max_seq_len,
         ):
-            tokens = repeat(stage_start_tokens, "d -> b 1 d", b=batch_size)
+            tokens = stage_start_tokens.expand(batch_size, 1, -1)
 
             if exists(prev_stage_tokens_repr):
                 tokens = tokens + prev_stage_tokens_repr[..., : tokens.shape[-2], :]
 
-            tokens = transformer(tokens)
+            tokens = self.attend_stage(transformer, tokens, stage_seq_len + 1)
             prev_stage_tokens_repr = proj(tokens)
 
         return self.to_logits(tokens)
 
-    def forward(self, ids, targets, return_loss=True):
+    def forward(self, ids, targets=None, return_loss=True):
         # we need to remove the sos token and pull the last token from the target
         # megabyte handles the sos token internally
 
-        ids = ids[:, :-1]
-        ids[:, :-1] = ids[:, 1:]
-        ids = torch.cat((ids, targets[:, -1:]), dim=-1)  # [b, t_main]
+        if exists(targets):
+            ids = torch.cat((ids[:, 1:], targets[:, -1:]), dim=-1)  # [b, t_main]
 
         batch = ids.shape[0]
 
@@ -573,7 +893,7 @@ class MegaByte(Module):
 
         num_stages = len(prec_dims)
 
-        tokens_at_stages = []
+        tokens_at_stages = [None] * num_stages
         pos_embs = default(self.pos_embs, (None,) * num_stages)
 
         for ind, pos_emb, token_emb in zip_longest(
@@ -584,15 +904,15 @@ class MegaByte(Module):
             tokens = token_emb(ids)
 
             if exists(pos_emb):
-                positions = pos_emb(torch.arange(tokens.shape[-2], device=device))
-                tokens = tokens + positions
+                # embedding of arange(n) is the first n rows of the table
+                tokens = tokens + pos_emb.weight[: tokens.shape[-2]]
 
-            tokens_at_stages.insert(0, tokens)
+            tokens_at_stages[num_stages - 1 - ind] = tokens
 
             if is_first:
                 continue
 
-            ids = rearrange(ids, "... m n -> ... (m n)")
+            ids = ids.flatten(-2, -1)  # ... m n -> ... (m n)
 
         # the un-pixelshuffled representations of the previous hierarchy, starts with None
 
@@ -600,38 +920,32 @@ class MegaByte(Module):
 
         # spatial tokens is tokens with depth pos reduced along depth dimension + spatial positions
 
-        for stage_start_tokens, stage_tokens, transformer, proj in zip(
+        for stage_start_tokens, stage_tokens, transformer, proj, stage_seq_len in zip(
             self.start_tokens,
             tokens_at_stages,
             self.transformers,
             self.to_next_transformer_projections,
+            self.max_seq_len,
         ):
-            stage_tokens, ps = pack_one(stage_tokens, "* n d")
-            stage_start_tokens = repeat(
-                stage_start_tokens, "f -> b 1 f", b=stage_tokens.shape[0]
-            )
+            # fold all preceding dims into one batch dim for the transformer
 
-            # concat start token
+            *prec_shape, n, d = stage_tokens.shape
+            stage_tokens = stage_tokens.reshape(-1, n, d)
 
-            stage_tokens = torch.cat(
-                (
-                    stage_start_tokens,
-                    stage_tokens,
-                ),
-                dim=-2,
-            )
+            # write the start token and the tokens, summed with the previous
+            # hierarchy's representation, into one buffer
 
-            # sum the previous hierarchy's representation
+            tokens = stage_tokens.new_empty((stage_tokens.shape[0], n + 1, d))
+            tokens[:, 0] = stage_start_tokens
 
             if exists(prev_stage_tokens_repr):
-                prev_stage_tokens_repr = F.pad(
-                    prev_stage_tokens_repr, (0, 0, 1, 0), value=0.0
-                )
-                stage_tokens = stage_tokens + prev_stage_tokens_repr
+                tokens[:, 1:] = stage_tokens + prev_stage_tokens_repr
+            else:
+                tokens[:, 1:] = stage_tokens
 
-            attended = transformer(stage_tokens)
+            attended = self.attend_stage(transformer, tokens, stage_seq_len + 1)
 
-            attended = unpack_one(attended, ps, "* n d")
+            attended = attended.reshape(*prec_shape, n + 1, d)
 
             # project for next stage in the hierarchy
 